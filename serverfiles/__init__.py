@@ -78,24 +78,33 @@ Local files
 
 """
 
+import bisect
+from collections import defaultdict
 import functools
+from concurrent.futures import ThreadPoolExecutor
 try:
     import urllib.parse as urlparse
 except ImportError:
     import urlparse
 from contextlib import contextmanager
 import threading
+import weakref
 import os
 import tarfile
 import gzip
 import bz2
 import datetime
-import tempfile
 import json
 try:
-    from html.parser import HTMLParser
+    from orjson import loads as _loads, dumps as _dumps
 except ImportError:
-    from HTMLParser import HTMLParser
+    from json import loads as _loads
+
+    def _dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+import sys
+import html
+import re
 import shutil
 
 import requests
@@ -110,15 +119,25 @@ except:
 # default socket timeout in seconds
 TIMEOUT = 5
 
+# number of concurrent requests to the server
+MAX_WORKERS = 16
+
+# size of blocks used when downloading and copying files
+CHUNKSIZE = 256 * 1024
+
+# size of blocks read from decompressors; fewer calls into the
+# decompression library are faster
+DECOMPRESSION_CHUNKSIZE = 1024 * 1024
+
 
 def _open_file_info(fname):
-    with open(fname, 'rt') as f:
-        return json.load(f)
+    with open(fname, 'rb') as f:
+        return _loads(f.read())
 
 
 def _save_file_info(fname, info):
-    with open(fname, 'wt') as f:
-        json.dump(info, f)
+    with open(fname, 'wb') as f:
+        f.write(_dumps(info))
 
 
 def _create_path(target):
@@ -128,36 +147,89 @@ def _create_path(target):
         pass
 
 
+def _remove_path(path):
+    """Remove a file or a folder if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
 def _is_prefix(pref, whole):
-    if len(pref) > len(whole):
-        return False
-    for a, b in zip(pref, whole):
-        if a != b:
-            return False
-    return True
-
-
-class _FindLinksParser(HTMLParser, object):
-
-    def __init__(self):
-        super(_FindLinksParser, self).__init__()
-        self.links = []
-
-    def handle_starttag(self, tag, attrs):
-        if tag == "a":
-            for name, value in attrs:
-                if name == "href":
-                    #ignore navidation and hidden files
-                    if value.startswith("?") or value.startswith("/") or \
-                       value.startswith(".") or value.startswith("__"):
-                        continue
-                    self.links.append(urlparse.unquote(value))
+    return whole[:len(pref)] == pref
+
+
+# links in directory listings; skips navigation (queries and anchors)
+_HREF_RE = re.compile(rb'<a\s[^>]*href="([^"#?][^"]*)"', re.I)
+
+
+def _find_links(content):
+    """Return unquoted links from a HTML directory listing."""
+    return [urlparse.unquote(html.unescape(m.group(1).decode("utf-8")))
+            for m in _HREF_RE.finditer(content)
+            #ignore navidation and hidden files
+            if not m.group(1).startswith((b"/", b".", b"__"))]
+
+
+@contextmanager
+def _partial_file(target):
+    """Yield a path of a partial file for target and rename it to target
+    on success, so that the target is either absent or complete. The
+    partial file is removed on failure."""
+    _create_path(os.path.dirname(target))
+    part = target + ".part"
+    try:
+        yield part
+        os.replace(part, target)
+    except:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+class _Progress:
+    """Call callback once for each downloaded percent, 100 times in total.
+    Can be updated from multiple threads."""
+
+    def __init__(self, callback, size):
+        self.callback = callback
+        self.size = size
+        self.readb = 0
+        self.reported = 0
+        self._lock = threading.Lock()
+
+    def _report(self, percent):
+        while self.reported < percent:
+            self.reported += 1
+            if self.callback:
+                self.callback()
+
+    def update(self, n):
+        """Add n to the number of bytes read."""
+        with self._lock:
+            self.readb += n
+            self._report_read()
+
+    def set(self, readb):
+        """Set the number of bytes read."""
+        with self._lock:
+            self.readb = readb
+            self._report_read()
+
+    def _report_read(self):
+        if self.size:
+            self._report(min(self.readb * 100 // self.size, 99))
+
+    def finish(self):
+        with self._lock:
+            self._report(100)
 
 
 class ServerFiles:
     """A class for listing or downloading files from the server."""
 
-    def __init__(self, server, username=None, password=None):
+    def __init__(self, server, username=None, password=None,
+                 max_workers=MAX_WORKERS):
         if server.endswith('/'):
             self.server = server
         else:
@@ -167,95 +239,238 @@ class ServerFiles:
         """Username for authenticated HTTP queried."""
         self.password = password
         """Password for authenticated HTTP queried."""
+        self.max_workers = max_workers
+        """Maximum number of concurrent requests to the server."""
+
+        # a shared session keeps connections to the server alive
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            max_retries=3, pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
         # cached info for all files on server
         # None is not loaded, False if it does not exist
         self._info = None
+        # sorted paths from _info for prefix lookups
+        self._info_sorted = []
+        # info of single files, used when there is no __INFO__
+        self._info_cache = {}
+        # search index over _info, built on first search
+        self._search_index = None
+
+    def _set_info(self, info):
+        self._info = info
+        self._info_sorted = sorted(info) if info else []
+        self._info_cache = {}
+        self._search_index = None
+
+    def refresh(self):
+        """Forget cached file infos, so that they are queried again."""
+        self._set_info(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close connections to the server."""
+        self._session.close()
 
     def _download_server_info(self):
         if self._info is None:
             response = self._open("__INFO__")
             if response.status_code == 200:
-                self._info = {tuple(a): b for a, b in json.loads(response.text)}
+                # paths share many components, so intern them
+                self._set_info({tuple(sys.intern(p) for p in a): b
+                                for a, b in _loads(response.content)})
             else:
-                self._info = False #do not check again
-            response.close()
+                self._set_info(False) #do not check again
+                response.close()
 
     def listfiles(self, *args, **kwargs):
         """Return a list of files on the server. Do not list .info files."""
         recursive = kwargs.get("recursive", True)
         self._download_server_info()
         if self._info:
-            return [a for a in self._info.keys() if _is_prefix(args, a)]
+            # paths with the same prefix are adjacent in sorted order
+            keys = self._info_sorted
+            files = []
+            for i in range(bisect.bisect_left(keys, args), len(keys)):
+                if not _is_prefix(args, keys[i]):
+                    break
+                files.append(keys[i])
+            return files
+        if not recursive:
+            return self._listdir(*args)[0]
+
+        # list the tree level by level, each level with parallel requests
+        listing = {}
+        pending = [args]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending:
+                results = list(executor.map(lambda p: self._listdir(*p), pending))
+                listing.update(zip(pending, results))
+                pending = [d for _, dirs in results for d in dirs]
+
+        def collect(dir):
+            files, dirs = listing[dir]
+            return files + [f for d in dirs for f in collect(d)]
+
+        return collect(args)
+
+    def _listdir(self, *args):
+        """Return a pair of lists of files and subfolders in a folder."""
         response = self._open(*args)
-        parser = _FindLinksParser()
-        parser.feed(response.text)
+        links = _find_links(response.content)
         response.close()
-        links = parser.links
         files = [args + (f,) for f in links if not f.endswith("/") and not f.endswith(".info")]
-        if recursive:
-            for f in links:
-                if f.endswith("/"):
-                    f = f.strip("/")
-                    nargs = args + (f,)
-                    files.extend([a for a in self.listfiles(*nargs, recursive=True)])
-        return files
+        dirs = [args + (f.strip("/"),) for f in links if f.endswith("/")]
+        return files, dirs
 
     def download(self, *path, **kwargs):
         """
         Download a file and name it with target name. Callback
-        is called once for each downloaded percentage.
+        is called once for each downloaded percentage. The file is
+        first written to target + ".part" and then atomically renamed,
+        so the target is either absent or complete.
         """
         callback = kwargs.get("callback", None)
         target = kwargs.get("target", None)
-        _create_path(os.path.dirname(target))
 
-        response = self._open(*path)
-        if response.status_code == 404:
-            raise FileNotFoundError
-        elif response.status_code != 200:
-            raise IOError
+        response, progress = self._open_download(path, callback)
+        try:
+            with _partial_file(target) as part, open(part, "wb") as f:
+                for buf in response.iter_content(CHUNKSIZE):
+                    # content-length counts bytes as transferred, which
+                    # differs from len(buf) if the response is encoded
+                    progress.set(response.raw.tell())
+                    f.write(buf)
+        finally:
+            response.close()
 
-        size = response.headers.get('content-length')
-        if size:
-            size = int(size)
+        progress.finish()
 
-        with tempfile.TemporaryFile() as f:
-            chunksize = 1024*8
-            lastchunkreport= 0.0001
+    def download_and_decompress(self, *path, **kwargs):
+        """
+        Download a file compressed with gz or bz2 (given as compression)
+        and decompress it while downloading. Other arguments are the same
+        as for :obj:`download`.
+        """
+        callback = kwargs.get("callback", None)
+        target = kwargs.get("target", None)
+        compression = kwargs.get("compression", None)
+        if compression == "gz":
+            def decompressor(fileobj):
+                return gzip.GzipFile(fileobj=fileobj)
+        elif compression == "bz2":
+            decompressor = bz2.BZ2File
+        else:
+            raise ValueError("Unsupported compression: %s" % compression)
 
-            readb = 0
+        # the decompressor reads the raw stream, so it must not be encoded
+        response, progress = self._open_download(
+            path, callback, headers={"Accept-Encoding": "identity"})
+        try:
+            with _partial_file(target) as part, \
+                    decompressor(response.raw) as fp, \
+                    open(part, "wb") as f:
+                while True:
+                    buf = fp.read(DECOMPRESSION_CHUNKSIZE)
+                    if not buf:
+                        break
+                    f.write(buf)
+                    # progress is measured on compressed bytes
+                    progress.set(response.raw.tell())
+        finally:
+            response.close()
 
-            for buf in response.iter_content(chunksize):
-                readb += len(buf)
-                while size and float(readb) / size > lastchunkreport+0.01:
-                    lastchunkreport += 0.01
-                    if callback:
-                        callback()
-                f.write(buf)
+        progress.finish()
 
-            f.seek(0)
-            with open(target, "wb") as fo:
-                shutil.copyfileobj(f, fo)
+    def download_parallel(self, *path, **kwargs):
+        """
+        Download a file like :obj:`download`, but fetch its parts over
+        several connections at once with HTTP range requests. Argument
+        workers (default 4) limits the number of connections to the server
+        and min_part (default 8 MiB) sets the smallest part size in bytes.
+        Small files and servers without range support fall back to
+        :obj:`download`.
+        """
+        callback = kwargs.get("callback", None)
+        target = kwargs.get("target", None)
+        workers = kwargs.get("workers", 4)
+        min_part = kwargs.get("min_part", 8 * 1024 * 1024)
 
+        response = self._open(*path, method="HEAD",
+                              headers={"Accept-Encoding": "identity"})
         response.close()
-
-        if callback and not size: #size was unknown, call callbacks
-            for i in range(99):
-                callback()
-
-        if callback:
-            callback()
+        if response.status_code == 404:
+            raise FileNotFoundError
+        size = int(response.headers.get('content-length') or 0)
+        nparts = min(workers, size // max(min_part, 1))
+        if response.status_code != 200 or nparts < 2 \
+                or response.headers.get('accept-ranges') != "bytes":
+            return self.download(*path, target=target, callback=callback)
+
+        bounds = [size * i // nparts for i in range(nparts + 1)]
+        progress = _Progress(callback, size)
+
+        with _partial_file(target) as part:
+            def fetch(start, end):
+                response = self._open(*path, headers={
+                    "Range": "bytes=%d-%d" % (start, end - 1),
+                    "Accept-Encoding": "identity"})
+                try:
+                    if response.status_code != 206:
+                        raise IOError
+                    # each part writes through its own file object
+                    with open(part, "r+b") as f:
+                        f.seek(start)
+                        for buf in response.iter_content(CHUNKSIZE):
+                            progress.update(len(buf))
+                            f.write(buf)
+                        if f.tell() != end:
+                            raise IOError
+                finally:
+                    response.close()
+
+            with open(part, "wb") as f:
+                f.truncate(size)
+            with ThreadPoolExecutor(max_workers=nparts) as executor:
+                list(executor.map(fetch, bounds[:-1], bounds[1:]))
+
+        progress.finish()
+
+    def _open_download(self, path, callback, **kwargs):
+        """Open a file on the server for download and return the response
+        and its progress reporter. Raise FileNotFoundError or IOError if
+        the file can not be downloaded."""
+        response = self._open(*path, **kwargs)
+        if response.status_code != 200:
+            response.close()
+            if response.status_code == 404:
+                raise FileNotFoundError
+            raise IOError
+        size = int(response.headers.get('content-length') or 0)
+        return response, _Progress(callback, size)
 
     def allinfo(self, *path, **kwargs):
         """Return all info files in a dictionary, where keys are paths."""
         recursive = kwargs.get("recursive", True)
         self._download_server_info()
         files = self.listfiles(*path, recursive=recursive)
-        infos = {}
-        for npath in files:
-            infos[npath] = self.info(*npath)
-        return infos
+        return self._infos(files)
+
+    def _infos(self, files):
+        """Return infos for a list of paths in a dictionary. Without
+        __INFO__, query the server in parallel."""
+        self._download_server_info()
+        if self._info:
+            return {npath: self.info(*npath) for npath in files}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(files, executor.map(lambda p: self.info(*p), files)))
 
     def search(self, sstrings, **kwargs):
         """
@@ -267,50 +482,69 @@ class ServerFiles:
         this function.
         """
         if self._info is None or self._info is False:
-            self._info = self.allinfo()
-        return _search(self._info, sstrings, **kwargs)
+            self._set_info(self.allinfo())
+        if self._search_index is None:
+            self._search_index = _SearchIndex(self._info)
+        return self._search_index.search(sstrings, **kwargs)
 
     def info(self, *path):
-        """Return a dictionary containing repository file info."""
+        """Return a dictionary containing repository file info.
+        Infos are cached, so changes on the server are not seen
+        until :obj:`refresh` is called."""
         self._download_server_info()
         if self._info:
             return self._info.get(path, {})
-        path = list(path)
-        path[-1] += ".info"
-        response = self._open(*path)
+        if path in self._info_cache:
+            return self._info_cache[path]
+        ipath = list(path)
+        ipath[-1] += ".info"
+        response = self._open(*ipath)
 
         _info = {}
         if response.status_code == 200:
-            _info = json.loads(response.text)
+            _info = _loads(response.content)
 
         response.close()
+        if response.status_code in (200, 404):
+            self._info_cache[path] = _info
         return _info
 
-    def _server_request(self, root, *path) -> requests.Response:
+    def _server_request(self, root, *path, **kwargs) -> requests.Response:
         auth = None
         if self.username and self.password:
             auth = (self.username, self.password)
 
-        adapter = requests.adapters.HTTPAdapter(max_retries=3)
-        session = requests.Session()
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
+        method = kwargs.pop("method", "GET")
+        return self._session.request(method, root + "/".join(path), auth=auth,
+                                     timeout=TIMEOUT, stream=True, **kwargs)
+
+    def _open(self, *args, **kwargs) -> requests.Response:
+        return self._server_request(self.server, *args, **kwargs)
+
+
+class _Lock:
+    """Wraps a lock so that it can be weakly referenced."""
+
+    __slots__ = ("_lock", "__weakref__")
 
-        return session.get(root + "/".join(path), auth=auth,
-                           timeout=TIMEOUT, stream=True)
+    def __init__(self, lock):
+        self._lock = lock
 
-    def _open(self, *args) -> requests.Response:
-        return self._server_request(self.server, *args)
+    def acquire(self, *args):
+        return self._lock.acquire(*args)
+
+    def release(self):
+        self._lock.release()
 
 
 def _keyed_lock(lock_constructor=threading.Lock):
     lock = threading.Lock()
-    locks = {}
+    # a lock is dropped when no thread holds or waits for it
+    locks = weakref.WeakValueDictionary()
     def get_lock(key):
+        new = _Lock(lock_constructor())
         with lock:
-            if key not in locks:
-                locks[key] = lock_constructor()
-            return locks[key]
+            return locks.setdefault(key, new)
     return get_lock
 
 
@@ -318,16 +552,6 @@ def _keyed_lock(lock_constructor=threading.Lock):
 _get_lock = _keyed_lock(threading.RLock)
 
 
-def _split_path(head):
-    out = []
-    while True:
-        head, tail = os.path.split(head)
-        out.insert(0, tail)
-        if not head:
-            break
-    return out
-
-
 class LocalFiles:
     """Manage local files."""
 
@@ -373,32 +597,46 @@ class LocalFiles:
 
         extract = extract and "compression" in info
         target = self.localpath(*path)
-        self.serverfiles.download(*path,
-                                  target=target + ".tmp" if extract else target,
-                                  callback=callback)
-
-        _save_file_info(target + '.info', info)
+        # write to temporary files and move them into place at the end,
+        # data before info, so that an interrupted download never leaves
+        # an info file next to incomplete data
+        suffix = ".tmp.%d" % os.getpid()
+        compressed = target + ".download" + suffix
+        staging = target + suffix
+        info_staging = target + ".info" + suffix
+        try:
+            if extract and info.get("compression") in ["gz", "bz2"]:
+                # decompress while downloading
+                self.serverfiles.download_and_decompress(
+                    *path, target=staging, compression=info["compression"],
+                    callback=callback)
+            elif extract:
+                self.serverfiles.download(*path, target=compressed,
+                                          callback=callback)
+                if info.get("compression") in ["tar.gz", "tar.bz2"]:
+                    with tarfile.open(compressed) as temp_fp:
+                        os.mkdir(staging)
+                        # extraction filters are not available on older Pythons
+                        if hasattr(tarfile, "data_filter"):
+                            temp_fp.extractall(staging, filter="data")
+                        else:
+                            temp_fp.extractall(staging)
+                else:
+                    os.replace(compressed, staging)
+            else:
+                self.serverfiles.download(*path, target=staging,
+                                          callback=callback)
 
-        if not extract:
-            return
+            _save_file_info(info_staging, info)
 
-        if info.get("compression") in ["tar.gz", "tar.bz2"]:
-            with tarfile.open(target + ".tmp") as temp_fp:
-                try:
-                    os.mkdir(target)
-                except OSError:
-                    pass
-                temp_fp.extractall(target)
-        elif info.get("compression") == "gz":
-            with gzip.open(target + ".tmp") as temp_fp:
-                with open(target, "wb") as fp:
-                    shutil.copyfileobj(temp_fp, fp)
-        elif info.get("compression") == "bz2":
-            with bz2.BZ2File(target + ".tmp", "r") as temp_fp:
-                with open(target, "wb") as fp:
-                    shutil.copyfileobj(temp_fp, fp)
-
-        os.remove(target + ".tmp")
+            # folders can not be replaced atomically
+            if os.path.isdir(target) or os.path.isdir(staging):
+                _remove_path(target)
+            os.replace(staging, target)
+            os.replace(info_staging, target + ".info")
+        finally:
+            for tmp in (compressed, staging, info_staging):
+                _remove_path(tmp)
 
     @_locked
     def localpath_download(self, *path, **kwargs):
@@ -411,23 +649,38 @@ class LocalFiles:
             self.download.unwrapped(self, *path, **kwargs)
         return pathname
 
+    def _listinfo(self, *path):
+        """Yield paths of files with valid .info files and their infos."""
+        pending = [(self.localpath(*path), path)]
+        while pending:
+            dir, dpath = pending.pop()
+            try:
+                with os.scandir(dir) as it:
+                    entries = {entry.name: entry for entry in it}
+            except OSError:
+                continue
+            # companion files are looked up by name, without a stat
+            described = set()
+            for name, entry in entries.items():
+                if name[-5:] == '.info' and name[:-5] in entries \
+                        and entry.is_file():
+                    try:
+                        info = _open_file_info(entry.path)
+                    except ValueError:
+                        continue
+                    described.add(name[:-5])
+                    yield dpath + (name[:-5],), info
+            # do not descend into extracted archives or symlinked folders
+            subdirs = [(entry.path, dpath + (name,))
+                       for name, entry in entries.items()
+                       if name not in described
+                       and entry.is_dir(follow_symlinks=False)]
+            pending.extend(reversed(subdirs))
+
     def listfiles(self, *path):
         """List files (or folders) in local repository that have
         corresponding .info files.  Do not list .info files."""
-        dir = self.localpath(*path)
-        files = []
-        for root, dirs, fnms in os.walk(dir):
-            for f in fnms:
-                if f[-5:] == '.info' and os.path.exists(os.path.join(root, f[:-5])):
-                    try:
-                        _open_file_info(os.path.join(root, f))
-                        files.append(
-                            path + tuple(_split_path(
-                                os.path.relpath(os.path.join(root, f[:-5]), start=dir)
-                            )))
-                    except ValueError:
-                        pass
-        return files
+        return [filename for filename, _ in self._listinfo(*path)]
 
     def info(self, *path):
         """Return .info file for a file in a local repository."""
@@ -436,23 +689,23 @@ class LocalFiles:
 
     def allinfo(self, *path):
         """Return all local info files in a dictionary, where keys are paths."""
-        files = self.listfiles(*path)
-        dic = {}
-        for filename in files:
-            dic[filename] = self.info(*filename)
-        return dic
+        return dict(self._listinfo(*path))
 
-    def needs_update(self, *path):
+    def needs_update(self, *path, **kwargs):
         """Return True if a file does not exist in the local repository,
         if there is a newer version on the server or if either
-        version can not be determined."""
+        version can not be determined. Server info can be given with
+        server_info to avoid querying the server."""
+        server_info = kwargs.get("server_info", None)
         dt_fmt = "%Y-%m-%d %H:%M:%S"
         try:
             linfo = self.info(*path)
             dt_local = datetime.datetime.strptime(
                             linfo["datetime"][:19], dt_fmt)
+            if server_info is None:
+                server_info = self.serverfiles.info(*path)
             dt_server = datetime.datetime.strptime(
-                self.serverfiles.info(*path)["datetime"][:19], dt_fmt)
+                server_info["datetime"][:19], dt_fmt)
             return dt_server > dt_local
         except FileNotFoundError:
             return True
@@ -461,9 +714,10 @@ class LocalFiles:
 
     def update(self, *path, **kwargs):
         """Download the corresponding file from the server if server
-        copy was updated.
+        copy was updated. Server info can be given with server_info.
         """
-        if self.needs_update(*path):
+        server_info = kwargs.pop("server_info", None)
+        if self.needs_update(*path, server_info=server_info):
             self.download(*path, **kwargs)
 
     def search(self, sstrings, **kwargs):
@@ -472,11 +726,14 @@ class LocalFiles:
         list of tuples: first tuple element is the domain of the file, second
         its name."""
         si = self.allinfo()
-        return _search(si, sstrings, **kwargs)
+        return _SearchIndex(si).search(sstrings, **kwargs)
 
     def update_all(self, *path):
-        for fu in self.listfiles(*path):
-            self.update(*fu)
+        files = self.listfiles(*path)
+        # get server infos of local files at once instead of one by one
+        server_info = self.serverfiles._infos(files)
+        for fu in files:
+            self.update(*fu, server_info=server_info.get(fu, {}))
 
     @_locked
     def remove(self, *path):
@@ -495,28 +752,70 @@ class LocalFiles:
             raise FileNotFoundError
 
 
-def _search(si, sstrings, case_sensitive=False, in_tag=True, in_title=True, in_name=True):
-    found = []
-
-    for path, info in si.items():
-        target = ""
-        if in_tag: target += " ".join(info.get('tags', []))
-        if in_title: target += info.get('title', "")
-        if in_name: target += " ".join(path)
-        if not case_sensitive: target = target.lower()
-
-        match = True
-        for s in sstrings:
-            if not case_sensitive:
-                s = s.lower()
-            if s not in target:
-                match = False
-                break
-
-        if match:
-            found.append(path)
-
-    return found
+class _SearchIndex:
+    """Search over a dictionary of file infos. Search targets are prepared
+    once for each combination of search options. When the same options
+    are used again, an index of three-character substrings narrows down
+    the candidates before the substring checks."""
+
+    def __init__(self, si):
+        self.si = si
+        # search options -> [paths, targets, trigram index or None]
+        self._indices = {}
+
+    def _targets(self, case_sensitive, in_tag, in_title, in_name):
+        paths = []
+        targets = []
+        for path, info in self.si.items():
+            target = ""
+            if in_tag: target += " ".join(info.get('tags', []))
+            if in_title: target += info.get('title', "")
+            if in_name: target += " ".join(path)
+            if not case_sensitive: target = target.lower()
+            paths.append(path)
+            targets.append(target)
+        return paths, targets
+
+    @staticmethod
+    def _trigrams(targets):
+        trigrams = defaultdict(set)
+        for i, target in enumerate(targets):
+            for j in range(len(target) - 2):
+                trigrams[target[j:j+3]].add(i)
+        return trigrams
+
+    def search(self, sstrings, case_sensitive=False, in_tag=True, in_title=True,
+               in_name=True):
+        key = (case_sensitive, in_tag, in_title, in_name)
+        if key not in self._indices:
+            # a single search is faster without the index
+            self._indices[key] = list(self._targets(*key)) + [None]
+        elif self._indices[key][2] is None:
+            self._indices[key][2] = self._trigrams(self._indices[key][1])
+        paths, targets, trigrams = self._indices[key]
+
+        if not case_sensitive:
+            sstrings = [s.lower() for s in sstrings]
+        # longer substrings are rarer, so checking them first rejects
+        # non-matching files sooner
+        sstrings = sorted(set(sstrings), key=len, reverse=True)
+
+        candidates = None
+        if trigrams is not None:
+            grams = {s[j:j+3] for s in sstrings for j in range(len(s) - 2)}
+            for gram in grams:
+                found = trigrams.get(gram, set())
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    return []
+        if candidates is None:
+            candidates = range(len(paths))
+
+        return [paths[i] for i in sorted(candidates)
+                if all(s in targets[i] for s in sstrings)]
+
+
+_SIZE_UNITS = ('KB', 'MB', 'GB', 'TB', 'PB')
 
 
 def sizeformat(size):
@@ -529,14 +828,11 @@ def sizeformat(size):
     '1.5 MB'
 
     """
-    for unit in ['bytes', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024.0:
-            if unit == "bytes":
-                return "%1.0f %s" % (size, unit)
-            else:
-                return "%3.1f %s" % (size, unit)
-        size /= 1024.0
-    return "%.1f PB" % size
+    if size < 1024:
+        return "%1.0f bytes" % size
+    # the magnitude in powers of 1024 from the bit length
+    exp = min((int(size).bit_length() - 1) // 10, len(_SIZE_UNITS))
+    return "%3.1f %s" % (size / (1 << (10 * exp)), _SIZE_UNITS[exp - 1])
 
 
 if __name__ == '__main__':
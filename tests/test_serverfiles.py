@@ -11,6 +11,8 @@ except ImportError:
     from SimpleHTTPServer import SimpleHTTPRequestHandler
     from BaseHTTPServer import HTTPServer
 import tempfile
+import io
+import re
 import gzip
 import bz2
 import tarfile
@@ -27,12 +29,50 @@ except:
 
 DATETIMETEST = "2013-07-03 11:39:07.381031"
 
+RANGEDATA = b"".join(b"%d," % i for i in range(20000))
+
 
 def create(name, contents):
     with open(os.path.join(*name), "wt") as f:
         f.write(contents)
 
 
+def count_requests(sf):
+    """Record arguments of all requests made by a ServerFiles."""
+    requests = []
+    open_ = sf._open
+    def _open(*args, **kwargs):
+        requests.append(args)
+        return open_(*args, **kwargs)
+    sf._open = _open
+    return requests
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves byte ranges of files in folder "ranges". Files in folder
+    "badranges" claim range support, but are always sent whole."""
+
+    def send_head(self):
+        folder = self.path.lstrip("/").split("/")[0]
+        path = self.translate_path(self.path)
+        if folder not in ("ranges", "badranges") or not os.path.isfile(path):
+            return super().send_head()
+        with open(path, "rb") as f:
+            data = f.read()
+        match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range", ""))
+        if match and folder == "ranges":
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
+
+
 def server(path, info):
     os.chdir(path)
 
@@ -56,6 +96,11 @@ def server(path, info):
     os.remove("intar")
     create(("comp", "tar.gz.info"), '{"compression": "tar.gz"}')
 
+    for folder in ("ranges", "badranges"):
+        os.mkdir(folder)
+        with open(os.path.join(folder, "big"), "wb") as f:
+            f.write(RANGEDATA)
+
     if info:
         create(("__INFO__",), '''[[["comp", "gz"], {"compression": "gz"}],
 [["comp", "bz2"], {"compression": "bz2"}],
@@ -66,7 +111,7 @@ def server(path, info):
     # http server outputs a line for every connection
     sys.stderr = open(os.devnull, "w")
 
-    httpd = HTTPServer(("", 12345),  SimpleHTTPRequestHandler)
+    httpd = HTTPServer(("", 12345),  RangeRequestHandler)
     httpd.serve_forever()
 
 
@@ -116,6 +161,15 @@ class TestServerFiles(unittest.TestCase):
         lall = self.sf.listfiles()
         self.assertGreaterEqual(set(lall), set(ldomain))
 
+    def test_listdir_server_serial(self):
+        sf = serverfiles.ServerFiles(server="http://localhost:12345/", max_workers=1)
+        self.assertEqual(sf.listfiles(), self.sf.listfiles())
+        self.assertEqual(sf.allinfo(), self.sf.allinfo())
+
+    def test_context_manager(self):
+        with serverfiles.ServerFiles(server="http://localhost:12345/") as sf:
+            self.assertEqual(sf.info("domain1", "withinfo")["datetime"], DATETIMETEST)
+
     def test_download(self):
         self.lf.download("domain1", "withinfo")
         self.lf.download("domain1", "withoutinfo")
@@ -128,6 +182,41 @@ class TestServerFiles(unittest.TestCase):
         slist = self.sf.listfiles("domain1")
         self.assertEqual(set(llist), set(slist))
 
+    def test_download_parallel(self):
+        target = os.path.join(self.path, "parallel")
+        self.sf.download_parallel("domain1", "withinfo", target=target, min_part=1)
+        with open(target, "rt") as f:
+            self.assertEqual(f.read(), "with info")
+        self.assertFalse(os.path.exists(target + ".part"))
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.sf.download_parallel("domain1", "wrong file",
+                                                            target=target))
+
+    def test_download_parallel_ranges(self):
+        class CB:
+            run = 0
+            def __call__(self):
+                self.run += 1
+        cb = CB()
+        target = os.path.join(self.path, "parallel")
+        requests = count_requests(self.sf)
+        self.sf.download_parallel("ranges", "big", target=target, callback=cb,
+                                  min_part=len(RANGEDATA) // 5)
+        # a HEAD request and four parts
+        self.assertEqual(len(requests), 5)
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), RANGEDATA)
+        self.assertEqual(cb.run, 100)
+        self.assertFalse(os.path.exists(target + ".part"))
+
+    def test_download_parallel_ranges_ignored(self):
+        target = os.path.join(self.path, "parallel")
+        self.assertRaises(IOError,
+                          lambda: self.sf.download_parallel("badranges", "big",
+                                                            target=target, min_part=1000))
+        self.assertFalse(os.path.exists(target))
+        self.assertFalse(os.path.exists(target + ".part"))
+
     def test_compressed(self):
         self.lf.download("comp", "gz")
         self.lf.download("comp", "bz2")
@@ -147,6 +236,24 @@ class TestServerFiles(unittest.TestCase):
         self.assertFalse(os.path.exists(self.lf.localpath("comp", "tar.gz")))
         self.assertFalse(os.path.exists(self.lf.localpath("comp", "tar.gz.info")))
 
+    def test_redownload(self):
+        for _ in range(2):
+            self.lf.download("comp", "tar.gz")
+            self.lf.download("comp", "gz")
+        self.assertTrue(os.path.isdir(self.lf.localpath("comp", "tar.gz")))
+        self.assertEqual(sorted(os.listdir(self.lf.localpath("comp"))),
+                         ["gz", "gz.info", "tar.gz", "tar.gz.info"])
+
+    def test_listfiles_local(self):
+        self.lf.download("comp", "tar.gz")
+        self.lf.download("domain1", "withinfo")
+        # files in extracted archives are not listed
+        create((self.lf.localpath("comp", "tar.gz"), "inner"), "inner")
+        create((self.lf.localpath("comp", "tar.gz"), "inner.info"), "{}")
+        self.assertEqual(set(self.lf.listfiles()),
+                         set([("comp", "tar.gz"), ("domain1", "withinfo")]))
+        self.assertEqual(self.lf.listfiles("domain1"), [("domain1", "withinfo")])
+
     def test_info(self):
         self.lf.download("domain1", "withinfo")
         self.lf.download("domain1", "withoutinfo")
@@ -177,6 +284,34 @@ class TestServerFiles(unittest.TestCase):
         self.assertTrue(self.lf.needs_update("domain1", "withoutinfo"))
         self.lf.update_all()
 
+    def test_refresh(self):
+        self.sf.refresh()
+        requests = count_requests(self.sf)
+        self.sf.info("domain1", "withinfo")
+        first = len(requests)
+        self.sf.info("domain1", "withinfo")
+        self.assertEqual(len(requests), first)
+        self.sf.refresh()
+        self.assertEqual(self.sf.info("domain1", "withinfo")["datetime"], DATETIMETEST)
+        self.assertEqual(len(requests), 2 * first)
+
+    def test_update_all_requests(self):
+        self.lf.download("domain1", "withinfo")
+        sf = serverfiles.ServerFiles(server="http://localhost:12345/")
+        lf = serverfiles.LocalFiles(path=self.path, serverfiles=sf)
+        requests = count_requests(sf)
+        lf.update_all()
+        # only __INFO__ and the info of the single local file
+        self.assertLessEqual(len(requests), 2)
+        self.assertFalse(lf.needs_update("domain1", "withinfo"))
+
+    def test_update_server_info(self):
+        self.lf.download("domain1", "withinfo")
+        self.assertFalse(self.lf.needs_update("domain1", "withinfo"))
+        self.assertTrue(self.lf.needs_update(
+            "domain1", "withinfo", server_info={"datetime": "2014-01-01 00:00:00"}))
+        self.assertTrue(self.lf.needs_update("domain1", "withinfo", server_info={}))
+
     def test_search(self):
         self.lf.download("domain1", "withinfo")
         self.lf.download("domain1", "withoutinfo")
@@ -195,3 +330,98 @@ class TestServerFilesInfo(TestServerFiles):
         cls.http = multiprocessing.Process(target=server, args=[cls.pathserver, True])
         cls.http.daemon = True
         cls.http.start()
+
+
+def scan_search(si, sstrings, case_sensitive=False, in_tag=True, in_title=True,
+                in_name=True):
+    """Search by checking every file, like the original _search."""
+    found = []
+    for path, info in si.items():
+        target = ""
+        if in_tag: target += " ".join(info.get('tags', []))
+        if in_title: target += info.get('title', "")
+        if in_name: target += " ".join(path)
+        if not case_sensitive: target = target.lower()
+        if all((s if case_sensitive else s.lower()) in target for s in sstrings):
+            found.append(path)
+    return found
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.si = {
+            ("genes", "human.tab"): {"tags": ["Homo sapiens", "genes"],
+                                     "title": "Human Genes"},
+            ("genes", "mouse.tab"): {"tags": ["Mus musculus", "genes"],
+                                     "title": "Mouse genes"},
+            ("go", "gene_ontology.obo"): {"tags": ["ontology"],
+                                          "title": "Gene Ontology"},
+            ("other", "readme"): {},
+        }
+
+    def assertSearches(self, index, sstrings, **kwargs):
+        expected = scan_search(self.si, sstrings, **kwargs)
+        # the second search uses the trigram index
+        self.assertEqual(index.search(sstrings, **kwargs), expected)
+        self.assertEqual(index.search(sstrings, **kwargs), expected)
+        return expected
+
+    def test_case_insensitive(self):
+        index = serverfiles._SearchIndex(self.si)
+        self.assertEqual(self.assertSearches(index, ["HUMAN"]),
+                         [("genes", "human.tab")])
+        self.assertEqual(self.assertSearches(index, ["HUMAN"], case_sensitive=True),
+                         [])
+        self.assertEqual(self.assertSearches(index, ["Human"], case_sensitive=True),
+                         [("genes", "human.tab")])
+
+    def test_across_fields(self):
+        index = serverfiles._SearchIndex(self.si)
+        # tags are followed by the title and the title by the name
+        self.assertEqual(self.assertSearches(index, ["ontologygene ontologygo"]),
+                         [("go", "gene_ontology.obo")])
+        self.assertEqual(self.assertSearches(index, ["genesmouse"]),
+                         [("genes", "mouse.tab")])
+        self.assertEqual(self.assertSearches(index, ["genesmouse"], in_title=False),
+                         [])
+
+    def test_no_matching_trigram(self):
+        index = serverfiles._SearchIndex(self.si)
+        self.assertEqual(self.assertSearches(index, ["xyz"]), [])
+        self.assertEqual(self.assertSearches(index, ["genes", "xyz"]), [])
+
+    def test_mixed_lengths(self):
+        index = serverfiles._SearchIndex(self.si)
+        self.assertEqual(self.assertSearches(index, ["ge", "human"]),
+                         [("genes", "human.tab")])
+        self.assertEqual(self.assertSearches(index, ["m", "genes", "ab"]),
+                         [("genes", "human.tab"), ("genes", "mouse.tab")])
+        self.assertEqual(self.assertSearches(index, ["o", "ontology", "xy"]), [])
+
+    def test_repeated_strings(self):
+        index = serverfiles._SearchIndex(self.si)
+        self.assertEqual(self.assertSearches(index, ["genes", "GENES", "genes"]),
+                         [("genes", "human.tab"), ("genes", "mouse.tab")])
+        self.assertEqual(self.assertSearches(index, ["Genes", "genes"],
+                                             case_sensitive=True),
+                         [("genes", "human.tab")])
+
+    def test_empty_candidates(self):
+        index = serverfiles._SearchIndex(self.si)
+        # each trigram matches some file, but no file has all of them
+        self.assertEqual(self.assertSearches(index, ["human", "mouse"]), [])
+        self.assertEqual(self.assertSearches(index, []), list(self.si))
+
+    def test_options(self):
+        index = serverfiles._SearchIndex(self.si)
+        for kwargs in [{}, {"in_tag": False}, {"in_title": False},
+                       {"in_name": False}, {"case_sensitive": True}]:
+            self.assertSearches(index, ["gene"], **kwargs)
+            self.assertSearches(index, ["readme"], **kwargs)
+
+    def test_server_search(self):
+        sf = serverfiles.ServerFiles(server="http://localhost:1/")
+        sf._set_info(self.si)
+        self.assertEqual(sf.search(["mouse genes"]), [("genes", "mouse.tab")])
+        self.assertEqual(sf.search(["mouse genes"]), [("genes", "mouse.tab")])